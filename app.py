@@ -5,16 +5,33 @@
 # Для развертывания на Vercel используется файл `api/index.py`, который имеет аналогичную логику.
 
 import os
+import re # Используется для быстрой проверки структуры PDF без полного парсинга
+import zlib # Для распаковки потоков объектов PDF при подсчете страниц
+import bisect # Для сопоставления начал объектов PDF с маркерами endobj
 import deepl
 import requests # Используется для взаимодействия с API ApyHub и LibreTranslate
-from flask import Flask, request, render_template, send_from_directory, flash, redirect, url_for
+from flask import Flask, request, render_template, send_from_directory, flash, redirect, url_for, jsonify, Response, stream_with_context
 from werkzeug.utils import secure_filename
 import json # Используется для парсинга учетных данных JSON для Google Translate
+import threading # Блокировки для учета использования API и планировщика переводов
+import time # Для учета времени ожидания задач в очереди
+import uuid # Идентификаторы задач перевода
+from contextlib import contextmanager
+try:
+    import fcntl # Межпроцессная блокировка файла учета использования (нет в Windows)
+except ImportError:
+    fcntl = None
+from datetime import datetime, timezone # Для определения текущего бюджетного периода
 from dotenv import load_dotenv # Для загрузки переменных окружения из файла .env
 from google.cloud import translate_v3beta1 # Using v3beta1 for document translation features
 import google.oauth2.service_account # Added for explicit credential loading
 from google.cloud import storage # Added for Google Cloud Storage operations
 # import fitz # PyMuPDF for LibreTranslate text extraction/reinsertion (commented out)
+try:
+    import pikepdf # Необязательная зависимость для оптимизации переведенных PDF
+except ImportError:
+    pikepdf = None
+import hashlib # Для поиска одинаковых встроенных шрифтов
 
 # Загрузка переменных окружения из файла .env
 load_dotenv()
@@ -34,6 +51,12 @@ DOWNLOAD_FOLDER = '/tmp/downloads'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['DOWNLOAD_FOLDER'] = DOWNLOAD_FOLDER
 app.config['SECRET_KEY'] = os.urandom(24) # Установка секретного ключа для безопасности сессий Flask
+# Максимальный размер загружаемого файла (в мегабайтах). Flask отклоняет более крупные
+# запросы с ошибкой 413 еще до того, как файл будет прочитан целиком.
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_UPLOAD_MB", "20")) * 1024 * 1024
+# Фоновый перевод с передачей прогресса в браузер через Server-Sent Events.
+# Включено по умолчанию для локального запуска; требует долгоживущего процесса сервера.
+app.config['STREAM_PROGRESS'] = os.getenv("STREAM_PROGRESS", "true").lower() == "true"
 
 # Создание необходимых каталогов, если они еще не существуют
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -102,58 +125,768 @@ SUPPORTED_LANGUAGES = {
     "UK": "Ukrainian"
 }
 
+# Максимальное количество страниц для каждого движка перевода.
+# Значения можно переопределить переменными окружения MAX_PAGES_DEEPL, MAX_PAGES_GOOGLE, MAX_PAGES_APYHUB.
+MAX_PAGES_PER_ENGINE = {
+    "deepl": int(os.getenv("MAX_PAGES_DEEPL", "100")),
+    "google": int(os.getenv("MAX_PAGES_GOOGLE", "300")),
+    "apyhub": int(os.getenv("MAX_PAGES_APYHUB", "50")),
+}
+
+# Регулярные выражения для быстрой проверки PDF без полного парсинга документа.
+# Начала объектов и маркеры endobj ищутся отдельными линейными проходами, а затем
+# сопоставляются, чтобы время проверки не росло квадратично для поврежденных файлов.
+PDF_OBJ_START_RE = re.compile(rb"(?<!\d)(\d{1,10})\s+\d{1,5}\s+obj\b")
+PDF_ENDOBJ_RE = re.compile(rb"endobj")
+PDF_PAGE_RE = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+PDF_OBJSTM_RE = re.compile(rb"/Type\s*/ObjStm\b")
+PDF_ROOT_RE = re.compile(rb"/Root\s+(\d{1,10})\s+\d{1,5}\s+R")
+PDF_PAGES_REF_RE = re.compile(rb"/Pages\s+(\d{1,10})\s+\d{1,5}\s+R")
+PDF_COUNT_RE = re.compile(rb"/Count\s+(\d{1,10})\b(?!\s+\d+\s+R)")
+PDF_FIRST_RE = re.compile(rb"/First\s+(\d{1,10})")
+PDF_ENCRYPT_RE = re.compile(rb"/Encrypt\b")
+PDF_STREAM_START_RE = re.compile(rb"stream\r?\n")
+# Ограничения проверки: файлы, которые их превышают, отклоняются как непроверяемые.
+PDF_MAX_OBJECTS = 200000
+PDF_MAX_DECOMPRESSED_BYTES = 2 * app.config['MAX_CONTENT_LENGTH'] # Суммарно для всех потоков объектов
+
+def read_object_stream(body, max_length):
+    """
+    Распаковывает поток объектов (/ObjStm) и возвращает содержащиеся в нем объекты.
+
+    Args:
+        body (bytes): Текст объекта потока (словарь и данные потока).
+        max_length (int): Максимальный размер распакованных данных.
+
+    Returns:
+        tuple: ({номер объекта: текст объекта}, размер распакованных данных). Словарь пуст,
+        если поток не сжат FlateDecode или поврежден.
+
+    Raises:
+        ValueError: Если распакованные данные превышают max_length.
+    """
+    start = PDF_STREAM_START_RE.search(body)
+    first = PDF_FIRST_RE.search(body)
+    if not start or not first or b"/FlateDecode" not in body[:start.start()]:
+        return {}, 0
+    if max_length <= 0:
+        # max_length=0 означает для zlib отсутствие ограничения
+        raise ValueError("The uploaded PDF could not be validated (object streams are too large).")
+    decompressor = zlib.decompressobj()
+    try:
+        # decompressobj игнорирует данные после конца потока (endstream и переводы строк)
+        content = decompressor.decompress(body[start.end():], max_length)
+    except zlib.error:
+        return {}, 0
+    if decompressor.unconsumed_tail:
+        raise ValueError("The uploaded PDF could not be validated (object streams are too large).")
+
+    try:
+        first = int(first.group(1))
+        header = content[:first].split()
+        if len(header) % 2:
+            return {}, len(content)
+        numbers = [int(n) for n in header[0::2]]
+        offsets = [first + int(o) for o in header[1::2]] + [len(content)]
+    except ValueError:
+        return {}, len(content)
+    return {num: content[offsets[i]:offsets[i + 1]] for i, num in enumerate(numbers)}, len(content)
+
+def inspect_pdf(stream):
+    """
+    Проверяет загруженный PDF-файл до сохранения в каталог загрузок и отправки в API.
+
+    Тело загрузки читается в память целиком (его размер ограничен MAX_CONTENT_LENGTH;
+    крупные загрузки Werkzeug к этому моменту уже хранит во временном файле). Объекты
+    собираются по номерам, включая упакованные в потоки объектов (PDF 1.5+); при
+    инкрементальных обновлениях действует последнее определение объекта.
+
+    Args:
+        stream: Файловый объект загруженного файла (поддерживающий read/seek).
+
+    Returns:
+        dict: {"pages": количество страниц (0, если определить не удалось), "encrypted": bool}.
+
+    Raises:
+        ValueError: Если файл не похож на корректный PDF или превышает ограничения проверки.
+    """
+    stream.seek(0)
+    data = stream.read()
+    stream.seek(0)
+    if b"%PDF-" not in data[:1024]:
+        raise ValueError("The uploaded file is not a valid PDF (missing %PDF header).")
+    trailer = data[-2048:]
+    if b"%%EOF" not in trailer or b"startxref" not in trailer:
+        raise ValueError("The uploaded PDF is truncated or corrupt (missing xref/EOF marker).")
+
+    starts = []
+    for match in PDF_OBJ_START_RE.finditer(data):
+        starts.append(match)
+        if len(starts) > PDF_MAX_OBJECTS:
+            raise ValueError("The uploaded PDF could not be validated (too many objects).")
+    ends = [match.start() for match in PDF_ENDOBJ_RE.finditer(data)]
+
+    objects = {}
+    decompress_budget = PDF_MAX_DECOMPRESSED_BYTES
+    for i, match in enumerate(starts):
+        # Объект заканчивается на ближайшем endobj, но не дальше начала следующего объекта
+        limit = starts[i + 1].start() if i + 1 < len(starts) else len(data)
+        j = bisect.bisect_left(ends, match.end())
+        body = data[match.end():min(ends[j], limit) if j < len(ends) else limit]
+        # Словарь объекта без данных потока, чтобы не искать ключевые слова в содержимом страниц
+        objects[int(match.group(1))] = body.split(b"stream", 1)[0]
+        if PDF_OBJSTM_RE.search(objects[int(match.group(1))]):
+            packed, size = read_object_stream(body, decompress_budget)
+            decompress_budget -= size
+            objects.update(packed)
+
+    # Количество страниц берется из /Count корневого узла дерева страниц;
+    # если его найти не удалось, считаются листовые объекты /Type /Page.
+    pages = 0
+    roots = PDF_ROOT_RE.findall(data)
+    catalog = objects.get(int(roots[-1]), b"") if roots else b""
+    pages_ref = PDF_PAGES_REF_RE.search(catalog)
+    count = PDF_COUNT_RE.search(objects.get(int(pages_ref.group(1)), b"")) if pages_ref else None
+    if count:
+        pages = int(count.group(1))
+    else:
+        pages = sum(1 for body in objects.values() if PDF_PAGE_RE.search(body))
+
+    return {"pages": pages, "encrypted": bool(PDF_ENCRYPT_RE.search(data))}
+
+def validate_upload(file, engine):
+    """
+    Проверяет загруженный файл до его сохранения и отправки в движок перевода.
+
+    Args:
+        file: Объект FileStorage из request.files.
+        engine (str): Выбранный движок перевода.
+
+    Returns:
+        int: Количество страниц документа (0, если определить не удалось).
+
+    Raises:
+        ValueError: Если файл поврежден, зашифрован или превышает лимит страниц движка.
+    """
+    info = inspect_pdf(file.stream)
+    if info["encrypted"]:
+        raise ValueError("Encrypted or password-protected PDFs are not supported.")
+    max_pages = MAX_PAGES_PER_ENGINE.get(engine)
+    if max_pages and info["pages"] > max_pages:
+        raise ValueError(f"The document has {info['pages']} pages, but {engine} accepts at most {max_pages}.")
+    return info["pages"]
+
+@app.errorhandler(413)
+def file_too_large(error):
+    """
+    Обрабатывает ошибку превышения MAX_CONTENT_LENGTH.
+    """
+    message = f"File is too large. Maximum upload size is {app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB."
+    if wants_json():
+        return jsonify(error=message), 413
+    flash(message)
+    return redirect(url_for('index'))
+
+# Учет использования и бюджеты движков перевода.
+# DeepL тарифицирует символы (минимум 50 000 символов за документ), Google и ApyHub — страницы.
+# Бюджет задается в единицах тарификации движка на период BUDGET_PERIOD ("day" или "month");
+# 0 означает отсутствие ограничения. Стоимость единицы используется для выбора самого дешевого движка.
+USAGE_FILE = os.getenv("USAGE_FILE", "/tmp/translation_usage.json")
+BUDGET_PERIOD = os.getenv("BUDGET_PERIOD", "month")
+ESTIMATED_CHARS_PER_PAGE = int(os.getenv("ESTIMATED_CHARS_PER_PAGE", "2000"))
+DEEPL_MIN_BILLED_CHARS = 50000
+ENGINE_BILLING = {
+    "deepl": {
+        "unit": "characters",
+        "budget": int(os.getenv("BUDGET_DEEPL_CHARS", "0")),
+        "cost_per_unit": float(os.getenv("COST_DEEPL_PER_CHAR", "0.000025")),
+    },
+    "google": {
+        "unit": "pages",
+        "budget": int(os.getenv("BUDGET_GOOGLE_PAGES", "0")),
+        "cost_per_unit": float(os.getenv("COST_GOOGLE_PER_PAGE", "0.08")),
+    },
+    "apyhub": {
+        "unit": "pages",
+        "budget": int(os.getenv("BUDGET_APYHUB_PAGES", "0")),
+        "cost_per_unit": float(os.getenv("COST_APYHUB_PER_PAGE", "0.05")),
+    },
+}
+usage_lock = threading.Lock()
+
+# На Vercel каталог /tmp временный и свой у каждого экземпляра функции, поэтому
+# бюджеты соблюдаются только при USAGE_FILE на постоянном общем хранилище.
+if any(billing["budget"] for billing in ENGINE_BILLING.values()) and USAGE_FILE.startswith('/tmp/'):
+    print(f"Warning: translation budgets are tracked in {USAGE_FILE}, which is not persistent on serverless platforms. Set USAGE_FILE to a persistent path.")
+
+def current_period():
+    """
+    Возвращает ключ текущего бюджетного периода (например, "2024-05" или "2024-05-17").
+    """
+    now = datetime.now(timezone.utc)
+    return now.strftime("%Y-%m-%d") if BUDGET_PERIOD == "day" else now.strftime("%Y-%m")
+
+@contextmanager
+def locked_usage():
+    """
+    Блокирует файл учета использования на время чтения и изменения счетчиков.
+
+    Блокировка действует между потоками процесса (usage_lock) и, где доступен fcntl,
+    между процессами (например, воркерами gunicorn), через файл USAGE_FILE + ".lock".
+    На платформах без fcntl бюджеты соблюдаются только в пределах одного процесса.
+    """
+    with usage_lock:
+        with open(f"{USAGE_FILE}.lock", 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def load_usage():
+    """
+    Загружает накопленное использование из USAGE_FILE. Возвращает пустой словарь, если файла нет.
+
+    Формат: {период: {движок: {"used": единицы, "reserved": единицы}}}.
+
+    Raises:
+        ValueError: Если файл поврежден. Счетчики в этом случае не обнуляются,
+            а новые переводы отклоняются, пока файл не будет исправлен.
+    """
+    try:
+        with open(USAGE_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError as e:
+        print(f"ERROR: usage file {USAGE_FILE} is corrupt ({e}). Translation budgets cannot be checked until it is fixed.")
+        raise ValueError("Translation usage accounting is unavailable. Please try again later.")
+
+def save_usage(usage):
+    """
+    Атомарно сохраняет накопленное использование в USAGE_FILE (через временный файл и os.replace).
+    """
+    temp_path = f"{USAGE_FILE}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(usage, f)
+    os.replace(temp_path, USAGE_FILE)
+
+def reserve_usage(engine, units):
+    """
+    Резервирует оценку тарифицируемых единиц, если бюджет движка это позволяет.
+
+    Проверка и резервирование выполняются под одной блокировкой, поэтому задачи,
+    ожидающие в очереди или выполняющиеся параллельно, не могут превысить бюджет вместе.
+
+    Returns:
+        bool: True, если единицы зарезервированы.
+
+    Raises:
+        ValueError: Если файл учета поврежден.
+    """
+    budget = ENGINE_BILLING[engine]["budget"]
+    with locked_usage():
+        usage = load_usage()
+        counters = usage.setdefault(current_period(), {}).setdefault(engine, {"used": 0, "reserved": 0})
+        if budget and counters["used"] + counters["reserved"] + units > budget:
+            return False
+        counters["reserved"] += units
+        save_usage(usage)
+    return True
+
+def settle_usage(engine, reserved_units, billed_units=0):
+    """
+    Снимает резерв задачи и записывает фактическое использование.
+    При ошибке перевода вызывается с billed_units=0, чтобы просто освободить резерв.
+    """
+    with locked_usage():
+        try:
+            usage = load_usage()
+        except ValueError:
+            # Перевод уже выполнен, поэтому задача не завершается ошибкой; проблема записана в журнал
+            print(f"ERROR: could not record {billed_units} {ENGINE_BILLING[engine]['unit']} for {engine}")
+            return
+        counters = usage.setdefault(current_period(), {}).setdefault(engine, {"used": 0, "reserved": 0})
+        # Резерв мог быть сделан в прошлом периоде, поэтому счетчик не опускается ниже нуля
+        counters["reserved"] = max(counters["reserved"] - reserved_units, 0)
+        counters["used"] += billed_units
+        save_usage(usage)
+    if billed_units:
+        print(f"Recorded {billed_units} {ENGINE_BILLING[engine]['unit']} for {engine} in period {current_period()}")
+
+def estimate_billable_units(engine, pages):
+    """
+    Оценивает количество тарифицируемых единиц до отправки документа.
+
+    Args:
+        engine (str): Движок перевода.
+        pages (int): Количество страниц (0, если неизвестно).
+
+    Returns:
+        int: Оценка в единицах тарификации движка (символы для DeepL, страницы для остальных).
+    """
+    pages = max(pages, 1)
+    if engine == 'deepl':
+        return max(pages * ESTIMATED_CHARS_PER_PAGE, DEEPL_MIN_BILLED_CHARS)
+    return pages
+
+def is_engine_configured(engine):
+    """
+    Проверяет, настроены ли учетные данные для движка перевода.
+    """
+    if engine == 'deepl':
+        return deepl_client is not None
+    if engine == 'google':
+        return bool(google_translate_client and google_storage_client and GOOGLE_CLOUD_STORAGE_BUCKET)
+    if engine == 'apyhub':
+        return bool(APYHUB_API_KEY)
+    return False
+
+def has_account_quota(engine, estimate):
+    """
+    Проверяет остаток лимита аккаунта движка через его API (сейчас поддерживается только DeepL).
+    """
+    if engine != 'deepl':
+        return True
+    try:
+        usage = deepl_client.get_usage()
+    except deepl.DeepLException as e:
+        print(f"Could not fetch DeepL usage: {e}")
+        return True
+    if usage.any_limit_reached:
+        return False
+    if usage.character.valid and usage.character.limit - usage.character.count < estimate:
+        return False
+    return True
+
+def select_engine(requested, pages):
+    """
+    Выбирает движок перевода с учетом бюджетов и резервирует оценку его использования.
+
+    Если запрошен "auto" или у запрошенного движка закончился бюджет, выбирается самый
+    дешевый настроенный движок, у которого остался бюджет и подходит лимит страниц.
+    Резерв нужно снять через settle_usage() после перевода или при ошибке.
+
+    Returns:
+        tuple: (движок, зарезервированная оценка тарифицируемых единиц).
+
+    Raises:
+        ValueError: Если движок не настроен или ни у одного подходящего движка не осталось бюджета.
+    """
+    if requested != 'auto':
+        if requested not in ENGINE_BILLING:
+            raise ValueError("Invalid translation engine selected.")
+        if not is_engine_configured(requested):
+            raise ValueError(f"Translation engine '{requested}' is not configured on this server.")
+        estimate = estimate_billable_units(requested, pages)
+        if has_account_quota(requested, estimate) and reserve_usage(requested, estimate):
+            return requested, estimate
+        print(f"Budget for {requested} exhausted, looking for an alternative engine")
+
+    candidates = []
+    for engine, billing in ENGINE_BILLING.items():
+        if not is_engine_configured(engine):
+            continue
+        if pages > MAX_PAGES_PER_ENGINE.get(engine, pages):
+            continue
+        estimate = estimate_billable_units(engine, pages)
+        candidates.append((estimate * billing["cost_per_unit"], engine, estimate))
+    for _, engine, estimate in sorted(candidates):
+        if has_account_quota(engine, estimate) and reserve_usage(engine, estimate):
+            return engine, estimate
+    raise ValueError("Translation budget is exhausted for all available engines. Please try again later.")
+
+# Оптимизация переведенных PDF перед выдачей пользователю (требует pikepdf).
+# Отключается переменной окружения OPTIMIZE_OUTPUT=false.
+OPTIMIZE_OUTPUT = os.getenv("OPTIMIZE_OUTPUT", "true").lower() == "true"
+if OPTIMIZE_OUTPUT and pikepdf is None:
+    print("pikepdf is not installed. Translated PDFs will be served without optimization.")
+
+def page_resources(page_obj):
+    """
+    Возвращает словарь /Resources страницы, в том числе унаследованный от узлов /Pages.
+    """
+    node = page_obj
+    while isinstance(node, pikepdf.Dictionary):
+        resources = node.get("/Resources")
+        if isinstance(resources, pikepdf.Dictionary):
+            return resources
+        node = node.get("/Parent")
+    return None
+
+def dedupe_fonts(pdf):
+    """
+    Заменяет одинаковые встроенные шрифтовые программы ссылками на один объект.
+    Обходит ресурсы страниц (включая унаследованные) и вложенных Form XObject.
+
+    Returns:
+        int: Количество замененных дубликатов.
+    """
+    seen = {}
+    visited = set()
+    replaced = 0
+    pending = [page_resources(page.obj) for page in pdf.pages]
+    while pending:
+        resources = pending.pop()
+        if not isinstance(resources, pikepdf.Dictionary):
+            continue
+        if resources.is_indirect:
+            if resources.objgen in visited:
+                continue
+            visited.add(resources.objgen)
+
+        xobjects = resources.get("/XObject")
+        if isinstance(xobjects, pikepdf.Dictionary):
+            for _, xobject in xobjects.items():
+                if isinstance(xobject, pikepdf.Stream) and xobject.get("/Subtype") == pikepdf.Name.Form:
+                    pending.append(xobject.get("/Resources"))
+
+        fonts = resources.get("/Font")
+        if not isinstance(fonts, pikepdf.Dictionary):
+            continue
+        for _, font in fonts.items():
+            if not isinstance(font, pikepdf.Dictionary):
+                continue
+            descriptors = [font.get("/FontDescriptor")]
+            descendants = font.get("/DescendantFonts")
+            if isinstance(descendants, pikepdf.Array):
+                descriptors.extend(d.get("/FontDescriptor") for d in descendants if isinstance(d, pikepdf.Dictionary))
+            for descriptor in descriptors:
+                if not isinstance(descriptor, pikepdf.Dictionary):
+                    continue
+                for key in ("/FontFile", "/FontFile2", "/FontFile3"):
+                    stream = descriptor.get(key)
+                    if not isinstance(stream, pikepdf.Stream):
+                        continue
+                    digest = hashlib.sha256(stream.read_raw_bytes()).hexdigest()
+                    original = seen.setdefault(digest, stream)
+                    if original.objgen != stream.objgen:
+                        descriptor[key] = original
+                        replaced += 1
+    return replaced
+
+def optimize_pdf(path):
+    """
+    Сжимает переведенный PDF: объединяет одинаковые шрифты, пережимает потоки
+    и линеаризует файл для быстрого просмотра в браузере.
+
+    Файл заменяется только если оптимизированная версия меньше исходной.
+
+    Args:
+        path (str): Путь к PDF-файлу, который нужно оптимизировать на месте.
+
+    Returns:
+        int: Количество сэкономленных байт (0, если оптимизация не выполнялась).
+    """
+    if not OPTIMIZE_OUTPUT or pikepdf is None:
+        return 0
+    optimized_path = f"{path}.optimized"
+    try:
+        original_size = os.path.getsize(path)
+        with pikepdf.open(path) as pdf:
+            duplicates = dedupe_fonts(pdf)
+            pdf.remove_unreferenced_resources()
+            pdf.save(
+                optimized_path,
+                compress_streams=True,
+                recompress_flate=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                linearize=True,
+            )
+
+        optimized_size = os.path.getsize(optimized_path)
+        if optimized_size >= original_size:
+            os.remove(optimized_path)
+            print(f"Optimization did not reduce {path} ({original_size} bytes), keeping original")
+            return 0
+        os.replace(optimized_path, path)
+    except Exception as e:
+        # Оптимизация необязательна: при любой ошибке выдается неоптимизированный файл
+        print(f"Could not optimize {path}, serving it unoptimized: {e}")
+        if os.path.exists(optimized_path):
+            os.remove(optimized_path)
+        return 0
+
+    saved = original_size - optimized_size
+    print(f"Optimized {path}: {original_size} -> {optimized_size} bytes, saved {saved} bytes, {duplicates} duplicate fonts merged")
+    return saved
+
+# Планировщик переводов.
+# Задачи делятся на две полосы (lane) с отдельными лимитами одновременных переводов:
+# маленькие документы не ждут, пока освободится место за большими.
+# Внутри полосы первым запускается самая "короткая" задача (по страницам и байтам),
+# с учетом класса приоритета и старения, чтобы большие задачи не ждали бесконечно.
+# Очереди хранятся в памяти процесса: планирование действует только на долгоживущем
+# сервере с одним процессом, а на Vercel каждый запрос выполняется независимо.
+LARGE_JOB_PAGES = int(os.getenv("LARGE_JOB_PAGES", "50"))
+LARGE_JOB_BYTES = int(os.getenv("LARGE_JOB_MB", "10")) * 1024 * 1024
+BYTES_PER_PAGE_EQUIVALENT = 100 * 1024 # Сколько байт считаются эквивалентом одной страницы
+AGING_PAGES_PER_SECOND = float(os.getenv("SCHEDULER_AGING_RATE", "1.0")) # Насколько быстро растет приоритет ожидающей задачи
+PRIORITY_CLASSES = {
+    "interactive": 0,
+    "batch": 200, # Штраф в "страницах" для фоновых задач
+}
+SCHEDULER_LANES = {
+    "small": {"limit": int(os.getenv("SMALL_LANE_WORKERS", "4")), "running": 0, "waiting": []},
+    "large": {"limit": int(os.getenv("LARGE_LANE_WORKERS", "1")), "running": 0, "waiting": []},
+}
+scheduler_condition = threading.Condition()
+
+def job_score(job, now):
+    """
+    Вычисляет очередность задачи: чем меньше значение, тем раньше задача будет запущена.
+    """
+    cost = job["pages"] + job["size"] / BYTES_PER_PAGE_EQUIVALENT
+    return PRIORITY_CLASSES[job["priority"]] + cost - (now - job["submitted"]) * AGING_PAGES_PER_SECOND
+
+@contextmanager
+def translation_slot(pages, size, priority="interactive"):
+    """
+    Ожидает своей очереди на перевод и занимает место в соответствующей полосе.
+
+    Args:
+        pages (int): Количество страниц документа.
+        size (int): Размер документа в байтах.
+        priority (str): Класс приоритета ("interactive" или "batch").
+    """
+    if priority not in PRIORITY_CLASSES:
+        priority = "interactive"
+    is_large = pages > LARGE_JOB_PAGES or size > LARGE_JOB_BYTES
+    lane = SCHEDULER_LANES["large" if is_large else "small"]
+    job = {"pages": pages, "size": size, "priority": priority, "submitted": time.monotonic()}
+
+    with scheduler_condition:
+        lane["waiting"].append(job)
+        scheduler_condition.notify_all()
+        while True:
+            if lane["running"] < lane["limit"]:
+                now = time.monotonic()
+                if min(lane["waiting"], key=lambda j: job_score(j, now)) is job:
+                    break
+            scheduler_condition.wait()
+        lane["waiting"].remove(job)
+        lane["running"] += 1
+        # Другие задачи могут занять оставшиеся свободные места в полосе
+        scheduler_condition.notify_all()
+
+    try:
+        yield
+    finally:
+        with scheduler_condition:
+            lane["running"] -= 1
+            scheduler_condition.notify_all()
+
+# Задачи перевода и их состояние для потоковой передачи прогресса (Server-Sent Events).
+# Этапы: uploaded -> queued -> running (с процентом) -> downloading -> ready (или failed).
+# Состояние хранится в памяти процесса, поэтому потоковый режим требует долгоживущего сервера.
+JOB_TTL_SECONDS = 3600 # Через сколько секунд завершенные задачи удаляются из памяти
+SSE_KEEPALIVE_SECONDS = 15
+JOBS = {}
+jobs_condition = threading.Condition()
+
+def create_job():
+    """
+    Создает новую задачу перевода и удаляет устаревшие завершенные задачи.
+
+    Returns:
+        str: Идентификатор задачи.
+    """
+    job_id = uuid.uuid4().hex
+    now = time.monotonic()
+    with jobs_condition:
+        for old_id in [i for i, j in JOBS.items() if j["stage"] in ("ready", "failed") and now - j["updated"] > JOB_TTL_SECONDS]:
+            del JOBS[old_id]
+        JOBS[job_id] = {"stage": "uploaded", "progress": 0, "message": "", "notes": [], "download_url": None, "version": 0, "updated": now}
+    return job_id
+
+def update_job(job_id, stage, progress=None, **fields):
+    """
+    Обновляет этап и прогресс задачи и оповещает подписчиков SSE.
+    """
+    with jobs_condition:
+        job = JOBS[job_id]
+        job["stage"] = stage
+        if progress is not None:
+            job["progress"] = progress
+        job.update(fields)
+        job["version"] += 1
+        job["updated"] = time.monotonic()
+        jobs_condition.notify_all()
+
+def add_job_note(job_id, note):
+    """
+    Добавляет к задаче сообщение для пользователя (показывается после завершения).
+    """
+    with jobs_condition:
+        JOBS[job_id]["notes"].append(note)
+
+def process_translation(job_id, source_path, output_path, target_lang, engine, pages, estimated_units, priority):
+    """
+    Выполняет полный цикл перевода: ожидание в очереди, перевод, учет использования и оптимизацию.
+    Прогресс каждого этапа записывается в задачу job_id.
+    """
+    try:
+        update_job(job_id, "queued")
+        with translation_slot(pages, os.path.getsize(source_path), priority):
+            update_job(job_id, "running", 0)
+            billed_units = translate_pdf(
+                source_path, output_path, target_lang, engine,
+                progress=lambda stage, percent: update_job(job_id, stage, percent),
+            )
+    except Exception:
+        # Освобождение резерва бюджета, если перевод не удался
+        settle_usage(engine, estimated_units)
+        raise
+    # Замена резерва фактическим использованием (или оценкой, если API его не сообщает)
+    settle_usage(engine, estimated_units, billed_units if billed_units is not None else estimated_units)
+
+    # Необязательная оптимизация результата перед выдачей
+    saved_bytes = optimize_pdf(output_path)
+    if saved_bytes:
+        add_job_note(job_id, f'Translated PDF optimized, {saved_bytes // 1024} KB saved.')
+
+def run_translation_job(job_id, download_url, *args):
+    """
+    Выполняет перевод в фоновом потоке и отмечает задачу как готовую или завершившуюся ошибкой.
+    """
+    try:
+        process_translation(job_id, *args)
+        update_job(job_id, "ready", 100, download_url=download_url)
+    except Exception as e:
+        print(f"Translation job {job_id} failed: {e}")
+        update_job(job_id, "failed", message=f'An error occurred during translation: {e}')
+
+def wants_json():
+    """
+    Проверяет, отправлен ли запрос клиентским скриптом, ожидающим JSON вместо перенаправления.
+    """
+    return request.accept_mimetypes.best == 'application/json'
+
+def reject_upload(message):
+    """
+    Возвращает ошибку загрузки: JSON для клиентского скрипта или флеш-сообщение с перенаправлением.
+    """
+    if wants_json():
+        return jsonify(error=message), 400
+    flash(message)
+    return redirect(request.url)
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     """
     Обрабатывает запросы на главной странице.
     GET-запрос: отображает форму загрузки.
     POST-запрос: обрабатывает загрузку файла и запускает перевод.
+    Если клиент ожидает JSON, перевод запускается в фоне, а в ответе возвращается
+    адрес потока событий для отслеживания прогресса.
     """
     if request.method == 'POST':
         # Проверка наличия файла в запросе
         if 'file' not in request.files:
-            flash('No file part')
-            return redirect(request.url)
+            return reject_upload('No file part')
         file = request.files['file']
         # Проверка, был ли выбран файл
         if file.filename == '':
-            flash('No selected file')
-            return redirect(request.url)
+            return reject_upload('No selected file')
         # Проверка типа файла (только PDF)
-        if file and file.filename.endswith('.pdf'):
-            filename = secure_filename(file.filename) # Очистка имени файла для безопасности
-            source_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(source_path) # Сохранение загруженного файла
-
+        if file and file.filename.lower().endswith('.pdf'):
             target_lang = request.form.get('language') # Получение выбранного языка перевода
             if not target_lang:
-                flash('Please select a language')
-                return redirect(request.url)
+                return reject_upload('Please select a language')
             
             translation_engine = request.form.get('engine') # Получение выбранного движка перевода
             if not translation_engine:
-                flash('Please select a translation engine.')
-                return redirect(request.url)
+                return reject_upload('Please select a translation engine.')
+
+            # Быстрая проверка файла до сохранения и вызова платного API
+            try:
+                pages = validate_upload(file, translation_engine)
+                requested_engine = translation_engine
+                # Выбор движка с учетом бюджетов (и самого дешевого движка для "auto") и резервирование оценки
+                translation_engine, estimated_units = select_engine(requested_engine, pages)
+            except ValueError as e:
+                return reject_upload(str(e))
+
+            job_id = create_job()
+            # Идентификатор задачи в имени файла не дает одновременным загрузкам
+            # с одинаковыми именами перезаписать исходные и переведенные файлы друг друга
+            filename = f"{job_id}_{secure_filename(file.filename)}" # Очистка имени файла для безопасности
+            source_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+            try:
+                file.save(source_path) # Сохранение загруженного файла
+            except OSError as e:
+                settle_usage(translation_engine, estimated_units)
+                update_job(job_id, "failed", message=str(e))
+                return reject_upload(f'Could not save the uploaded file: {e}')
+
+            if requested_engine != 'auto' and translation_engine != requested_engine:
+                add_job_note(job_id, f'Budget for {requested_engine} is exhausted, {translation_engine} was used instead.')
+
+            # Формирование имени выходного файла и пути
+            output_filename = f"translated_{translation_engine}_{filename}"
+            output_path = os.path.join(app.config['DOWNLOAD_FOLDER'], output_filename)
+            download_url = url_for('download_file', filename=output_filename)
+            priority = request.form.get('priority', 'interactive')
+            job_args = (source_path, output_path, target_lang, translation_engine, pages, estimated_units, priority)
+
+            if app.config['STREAM_PROGRESS'] and wants_json():
+                # Перевод в фоне; клиент следит за прогрессом через /jobs/<job_id>/events
+                threading.Thread(target=run_translation_job, args=(job_id, download_url, *job_args), daemon=True).start()
+                return jsonify(job_id=job_id, events_url=url_for('job_events', job_id=job_id)), 202
 
             try:
-                # Формирование имени выходного файла и пути
-                output_filename = f"translated_{translation_engine}_{filename}"
-                output_path = os.path.join(app.config['DOWNLOAD_FOLDER'], output_filename)
-                
-                # Вызов функции перевода PDF
-                translate_pdf(source_path, output_path, target_lang, translation_engine)
+                process_translation(job_id, *job_args)
+                update_job(job_id, "ready", 100, download_url=download_url)
+                for note in JOBS[job_id]["notes"]:
+                    flash(note)
 
                 # Перенаправление на страницу скачивания переведенного файла
-                return redirect(url_for('download_file', filename=output_filename))
+                return redirect(download_url)
             except Exception as e:
                 # Обработка ошибок, возникших во время перевода
+                update_job(job_id, "failed", message=str(e))
                 flash(f'An error occurred during translation: {e}')
                 return redirect(request.url)
+        else:
+            return reject_upload('Only PDF files are supported.')
 
     # Отображение шаблона index.html с доступными языками
-    return render_template('index.html', languages=SUPPORTED_LANGUAGES)
+    return render_template('index.html', languages=SUPPORTED_LANGUAGES, stream_progress=app.config['STREAM_PROGRESS'])
 
-def translate_pdf(source_path, output_path, target_lang, engine):
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """
+    Передает этапы и прогресс задачи перевода в браузер через Server-Sent Events.
+    Поток закрывается после события "ready" или "failed".
+    """
+    if not app.config['STREAM_PROGRESS'] or job_id not in JOBS:
+        return jsonify(error='Unknown job'), 404
+
+    def generate():
+        last_version = -1
+        while True:
+            with jobs_condition:
+                job = JOBS.get(job_id)
+                if job is None:
+                    return
+                if job["version"] == last_version:
+                    jobs_condition.wait(timeout=SSE_KEEPALIVE_SECONDS)
+                version = job["version"]
+                event = {key: job[key] for key in ("stage", "progress", "message", "notes", "download_url")}
+            if version == last_version:
+                yield ": keep-alive\n\n" # Комментарий, чтобы прокси не закрыли неактивное соединение
+                continue
+            last_version = version
+            yield f"event: {event['stage']}\ndata: {json.dumps(event)}\n\n"
+            if event["stage"] in ("ready", "failed"):
+                return
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
+
+def translate_pdf(source_path, output_path, target_lang, engine, progress=None):
     """
     Переводит PDF-документ, используя выбранный API (DeepL, Google, ApyHub).
     
@@ -162,21 +895,44 @@ def translate_pdf(source_path, output_path, target_lang, engine):
         output_path (str): Путь для сохранения переведенного PDF-файла.
         target_lang (str): Код целевого языка (например, "RU", "UK").
         engine (str): Выбранный движок перевода ("deepl", "google", "apyhub").
+        progress (callable, optional): Функция progress(stage, percent), вызываемая при смене
+            этапа ("running", "downloading") и изменении процента выполнения.
+    
+    Returns:
+        int | None: Фактически тарифицированные единицы (символы для DeepL, страницы для Google)
+        или None, если API их не сообщает.
     
     Raises:
         ValueError: Если выбранный движок не настроен или недействителен.
         Exception: В случае ошибок API или других проблем с переводом.
     """
+    if progress is None:
+        progress = lambda stage, percent: None
+
     if engine == 'deepl':
         # Проверка, настроен ли клиент DeepL
         if not deepl_client:
             raise ValueError("DeepL API key is not configured. Please set DEEPL_API_KEY in your .env file.")
         print(f"Using DeepL for translation to {target_lang}")
-        deepl_client.translate_document_from_filepath(
-            source_path,
-            output_path,
-            target_lang=target_lang,
-        )
+        # Загрузка, ожидание и скачивание выполняются по отдельности, чтобы сообщать прогресс
+        with open(source_path, 'rb') as source_file:
+            handle = deepl_client.translate_document_upload(source_file, target_lang=target_lang)
+        status = deepl_client.translate_document_get_status(handle)
+        initial_seconds = None
+        while not status.done:
+            if status.seconds_remaining:
+                initial_seconds = initial_seconds or status.seconds_remaining
+                # DeepL может увеличить оценку времени, поэтому процент ограничивается диапазоном 0-99
+                percent = int(100 * (1 - status.seconds_remaining / initial_seconds))
+                progress("running", min(max(percent, 0), 99))
+            time.sleep(min(status.seconds_remaining or 1, 5))
+            status = deepl_client.translate_document_get_status(handle)
+        if not status.ok:
+            raise Exception(f"DeepL document translation failed: {status.error_message}")
+        progress("downloading", 100)
+        with open(output_path, 'wb') as output_file:
+            deepl_client.translate_document_download(handle, output_file)
+        billed_units = status.billed_characters
     elif engine == 'google':
         # Проверка, настроен ли клиент Google Translate
         if not google_translate_client or not GOOGLE_CLOUD_PROJECT_ID or not google_storage_client or not GOOGLE_CLOUD_STORAGE_BUCKET:
@@ -213,8 +969,16 @@ def translate_pdf(source_path, output_path, target_lang, engine):
         )
 
         print("Waiting for Google Cloud Document Translation operation to complete...")
-        response = operation.result(timeout=300) # Wait for the operation to complete, with a timeout
+        deadline = time.monotonic() + 300
+        while not operation.done() and time.monotonic() < deadline:
+            # The operation metadata reports how many pages have been translated so far
+            metadata = operation.metadata
+            if metadata is not None and metadata.total_pages:
+                progress("running", int(100 * metadata.translated_pages / metadata.total_pages))
+            time.sleep(2)
+        response = operation.result(timeout=max(deadline - time.monotonic(), 1)) # Wait for the operation to complete, with a timeout
         print("Google Cloud Document Translation operation completed.")
+        billed_units = response.total_billable_pages or None
 
         # The translated file will be in a subdirectory created by Google.
         # We need to find the actual translated file in GCS and download it.
@@ -226,6 +990,7 @@ def translate_pdf(source_path, output_path, target_lang, engine):
                 break
 
         if translated_pdf_blob:
+            progress("downloading", 100)
             translated_pdf_blob.download_to_filename(output_path)
             print(f"Downloaded translated file from GCS: {translated_pdf_blob.name} to {output_path}")
         else:
@@ -261,11 +1026,13 @@ def translate_pdf(source_path, output_path, target_lang, engine):
         try:
             response = requests.post(APYHUB_TRANSLATE_DOC_URL, params=params, headers=headers, files=files)
             response.raise_for_status() # Вызывает исключение для HTTP-ошибок (4xx или 5xx)
+            progress("downloading", 100)
             
             # Сохранение переведенного содержимого в выходной файл
             with open(output_path, 'wb') as f:
                 f.write(response.content)
             print(f"ApyHub Translation completed. Saved file: {output_path}")
+            billed_units = None # ApyHub не сообщает объем тарификации
         except requests.exceptions.RequestException as e:
             raise Exception(f"ApyHub API error: {e}")
         finally:
@@ -364,6 +1131,7 @@ def translate_pdf(source_path, output_path, target_lang, engine):
         raise ValueError("Invalid translation engine selected.")
     
     print(f"Перевод завершён. Сохранён файл: {output_path}")
+    return billed_units
 
 @app.route('/downloads/<filename>')
 def download_file(filename):
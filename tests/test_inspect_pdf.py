@@ -0,0 +1,71 @@
+# tests/test_inspect_pdf.py
+#
+# Проверки быстрой валидации загружаемых PDF (inspect_pdf) на синтетических документах.
+
+import io
+import os
+import sys
+import zlib
+
+import pytest
+
+# app.py импортирует клиенты API при загрузке модуля, поэтому тесты требуют установленных зависимостей
+for module in ("flask", "deepl", "dotenv", "google.cloud.translate_v3beta1", "google.cloud.storage"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from app import inspect_pdf  # noqa: E402
+
+TRAILER = b"\nstartxref\n0\n%%EOF\n"
+
+
+def make_pdf(pages, incremental=False):
+    objects = [b"1 0 obj<</Type /Catalog /Pages 2 0 R>>endobj", b"2 0 obj<</Type /Pages /Count %d>>endobj" % pages]
+    objects += [b"%d 0 obj<</Type /Page /Parent 2 0 R>>endobj" % (3 + i) for i in range(pages)]
+    data = b"%PDF-1.4\n" + b"\n".join(objects) + b"\ntrailer<</Root 1 0 R>>" + TRAILER
+    if incremental:
+        data += b"3 0 obj<</Type /Page /Parent 2 0 R /Rotate 90>>endobj\n" + objects[1] + b"\ntrailer<</Root 1 0 R>>" + TRAILER
+    return data
+
+
+def make_object_stream_pdf(header, content):
+    packed = zlib.compress(header + b" " + content)
+    return (b"%PDF-1.5\n" + b"1 0 obj<</Type /ObjStm /N 1 /First " + str(len(header) + 1).encode()
+            + b" /Filter /FlateDecode>>stream\n" + packed + b"\nendstream\nendobj" + TRAILER)
+
+
+def test_counts_pages_from_page_tree_root():
+    assert inspect_pdf(io.BytesIO(make_pdf(3))) == {"pages": 3, "encrypted": False}
+
+
+def test_incremental_update_is_not_counted_twice():
+    assert inspect_pdf(io.BytesIO(make_pdf(3, incremental=True)))["pages"] == 3
+
+
+def test_counts_pages_inside_object_streams():
+    assert inspect_pdf(io.BytesIO(make_object_stream_pdf(b"7 0", b"<</Type /Page>>")))["pages"] == 1
+
+
+@pytest.mark.parametrize("header", [b"1 0 2", b"1 x"])
+def test_malformed_object_stream_header_is_ignored(header):
+    assert inspect_pdf(io.BytesIO(make_object_stream_pdf(header, b"<</Type /Page>>")))["pages"] == 0
+
+
+def test_detects_encryption():
+    data = make_pdf(1).replace(b"trailer<<", b"trailer<</Encrypt 9 0 R ")
+    assert inspect_pdf(io.BytesIO(data))["encrypted"] is True
+
+
+@pytest.mark.parametrize("data", [b"not a pdf", make_pdf(1)[:-len(TRAILER)]])
+def test_rejects_invalid_files(data):
+    with pytest.raises(ValueError):
+        inspect_pdf(io.BytesIO(data))
+
+
+def test_rejects_object_stream_bomb():
+    compressor = zlib.compressobj(9)
+    bomb = b"".join(compressor.compress(b"\0" * (1 << 24)) for _ in range(8)) + compressor.flush()
+    data = (b"%PDF-1.5\n1 0 obj<</Type /ObjStm /N 1 /First 4 /Filter /FlateDecode>>stream\n"
+            + bomb + b"\nendstream\nendobj" + TRAILER)
+    with pytest.raises(ValueError, match="could not be validated"):
+        inspect_pdf(io.BytesIO(data))